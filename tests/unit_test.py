@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import contextlib
+import io
 import os
+import sqlite3
+import time
 from unittest.mock import Mock
+from urllib.parse import parse_qs
 
 from .. import translate
 from ..translate import Segment
 
 import pytest
 import deepl
+import httpx
 from environs import Env
 from docx import Document
 
@@ -539,3 +546,854 @@ def test_create_docx_file_check_table_content(list_of_translated_segment_objects
         assert row.cells[1].text == "positive hole transport layers 12"
 
     file_clean_up(docx_file_path)
+
+
+@pytest.mark.parametrize(
+    'user_input,expected', [
+
+        # Success cases
+
+        # No options given.
+        (['translate.py', 'tmx', 'source.docx'], (True, ['translate.py', 'tmx', 'source.docx'], {'--previous': None, '--resend': False, '--memory': None, '--document': False, '--profile': False})),
+        # Previous tmx file given after the positional args.
+        (['translate.py', 'tmx', 'source.docx', '--previous', 'source-translated.tmx'],
+         (True, ['translate.py', 'tmx', 'source.docx'], {'--previous': 'source-translated.tmx', '--resend': False, '--memory': None, '--document': False, '--profile': False})),
+        # Previous docx file given before the positional args.
+        (['translate.py', '--previous', 'source-translated.docx', 'docx', 'source.docx'],
+         (True, ['translate.py', 'docx', 'source.docx'], {'--previous': 'source-translated.docx', '--resend': False, '--memory': None, '--document': False, '--profile': False})),
+        # Whole document translation.
+        (['translate.py', '--document', 'docx', 'source.docx'],
+         (True, ['translate.py', 'docx', 'source.docx'], {'--previous': None, '--resend': False, '--memory': None, '--document': True, '--profile': False})),
+        # Profiling.
+        (['translate.py', 'tmx', 'source.docx', '--profile'],
+         (True, ['translate.py', 'tmx', 'source.docx'], {'--previous': None, '--resend': False, '--memory': None, '--document': False, '--profile': True})),
+        # Translation memory given.
+        (['translate.py', 'tmx', 'source.docx', '--memory', 'memory.db'],
+         (True, ['translate.py', 'tmx', 'source.docx'], {'--previous': None, '--resend': False, '--memory': 'memory.db', '--document': False, '--profile': False})),
+        # Resend flag given.
+        (['translate.py', 'tmx', 'source.docx', 'glossary.txt', '--resend'],
+         (True, ['translate.py', 'tmx', 'source.docx', 'glossary.txt'], {'--previous': None, '--resend': True, '--memory': None, '--document': False, '--profile': False})),
+
+        # Failure cases
+
+        # Unknown option.
+        (['translate.py', 'tmx', 'source.docx', '--random'], (False, None, None)),
+        # No previous file given.
+        (['translate.py', 'tmx', 'source.docx', '--previous'], (False, None, None)),
+        # Incorrect previous file type.
+        (['translate.py', 'tmx', 'source.docx', '--previous', 'glossary.txt'], (False, None, None)),
+        # Whole document translation with segments reused.
+        (['translate.py', 'tmx', 'source.docx', '--document', '--memory', 'memory.db'], (False, None, None)),
+        # No translation memory file given.
+        (['translate.py', 'tmx', 'source.docx', '--memory'], (False, None, None)),
+        (['translate.py', 'tmx', 'source.docx', '--memory', '--resend'], (False, None, None)),
+    ]
+)
+def test_user_options_check(user_input, expected):
+    assert translate.check_user_options(user_input) == expected
+
+
+def test_get_previous_segments_from_tmx(tmp_path, monkeypatch, list_of_translated_segment_objects):
+    monkeypatch.chdir(tmp_path)
+    translate.create_tmx("test-tmx-file", list_of_translated_segment_objects)
+    segments = translate.get_previous_segments("test-tmx-file-translated.tmx")
+    assert len(segments) == 10
+    for segment in segments:
+        assert segment.source_text == "正孔輸送層12"
+        assert segment.target_text == "positive hole transport layers 12"
+
+
+def test_get_previous_segments_from_docx(tmp_path, monkeypatch, list_of_translated_segment_objects):
+    monkeypatch.chdir(tmp_path)
+    translate.create_docx("test-docx-file", list_of_translated_segment_objects)
+    segments = translate.get_previous_segments("test-docx-file-translated.docx")
+    assert len(segments) == 10
+    for segment in segments:
+        assert segment.source_text == "正孔輸送層12"
+        assert segment.target_text == "positive hole transport layers 12"
+
+
+def test_reuse_previous_translations():
+    previous_segments = [
+        Segment(source_text="技術分野", target_text="Technical Field"),
+        Segment(source_text="背景技術", target_text="Background Art"),
+        Segment(source_text="特許文献", target_text="Patent Documents"),
+    ]
+    segments = [
+        Segment(source_text="技術分野", target_text=""),
+        Segment(source_text="先行技術文献", target_text=""),
+        Segment(source_text="特許文献", target_text=""),
+        Segment(source_text="発明の概要", target_text=""),
+    ]
+
+    changed_segments = translate.reuse_previous_translations(segments, previous_segments)
+
+    assert [segment.source_text for segment in changed_segments] == ["先行技術文献", "発明の概要"]
+    assert [segment.target_text for segment in segments] == ["Technical Field", "", "Patent Documents", ""]
+
+
+@pytest.mark.parametrize(
+    'source_text,expected', [
+
+        # Whitespace-only segments are copied through.
+        ('', ''),
+        ('　', '　'),
+        # Paragraph labels.
+        ('【００１２】', '[0012]'),
+        ('[0001]', '[0001]'),
+        # Figure references.
+        ('【図３】', '[FIG. 3]'),
+        ('図２Ａ', 'FIG. 2A'),
+        ('[図1(a)]', '[FIG. 1(a)]'),
+        # Unbalanced brackets are left for DeepL.
+        ('図1】', None),
+        ('【図1', None),
+        ('【図1]', None),
+        # Numbers and formulas.
+        ('１２３．４５', '123.45'),
+        ('x＝２y＋１', 'x=2y+1'),
+        # Circled numbers keep their meaning as list markers.
+        ('①', '(1)'),
+        ('⑫＋⑳', '(12)+(20)'),
+        # Chemical notations.
+        ('Ｈ２ＳＯ４', 'H2SO4'),
+        ('Ca(OH)2', 'Ca(OH)2'),
+        # Text requiring translation.
+        ('明細書', None),
+        ('特許文献1 : 特開２０１７－０７２５６０号公報', None),
+        ('12は', None),
+    ]
+)
+def test_get_local_translation(source_text, expected):
+    assert translate.get_local_translation(source_text) == expected
+
+
+def test_separate_local_segments(list_of_segment_objects_from_file):
+    pending_segments = translate.separate_local_segments(list_of_segment_objects_from_file)
+    source_texts = [segment.source_text for segment in pending_segments]
+    assert len(pending_segments) == 18
+    assert "[0001]" not in source_texts
+    assert list_of_segment_objects_from_file[3].target_text == "[0001]"
+
+
+def test_parse_glossary_lines_reports_malformed_lines_and_duplicates():
+    lines = [
+        "明細書\tDescription\n",
+        "\n",
+        "技術分野\n",
+        "特許文献\tPatent\tDocuments\n",
+        "明細書\tSpecification\n",
+        "表示部\tdisplay unit\n",
+        "表示部\tdisplay unit\n",
+    ]
+    entries, malformed_lines, duplicates = translate.parse_glossary_lines(lines)
+    assert entries == {"明細書": "Specification", "表示部": "display unit"}
+    assert malformed_lines == [3, 4]
+    assert duplicates == {"明細書": ["Description", "Specification"]}
+
+
+def test_load_glossary_entries_uses_cache(tmp_path, monkeypatch, mock_glossary_entries):
+    glossary_file = str(tmp_path / "glossary.txt")
+    with open(BASE_DIR + "/docs/test-glossary-1.txt", encoding="utf-8") as f:
+        content = f.read()
+    with open(glossary_file, "w", encoding="utf-8") as f:
+        f.write(content)
+
+    assert translate.load_glossary_entries(glossary_file) == mock_glossary_entries
+    assert os.path.exists(glossary_file + ".cache") is True
+
+    # The glossary should not be parsed again while the cache is up to date,
+    # including when only the modification time of the file has changed.
+    def fail(glossary_file):
+        raise AssertionError("glossary was parsed again")
+
+    monkeypatch.setattr(translate, "extract_glossary_entries", fail)
+    assert translate.load_glossary_entries(glossary_file) == mock_glossary_entries
+    os.utime(glossary_file, (0, 0))
+    assert translate.load_glossary_entries(glossary_file) == mock_glossary_entries
+
+
+def test_load_glossary_entries_rebuilds_changed_cache(tmp_path):
+    glossary_file = str(tmp_path / "glossary.txt")
+    with open(glossary_file, "w", encoding="utf-8") as f:
+        f.write("明細書\tDescription\n")
+    assert translate.load_glossary_entries(glossary_file) == {"明細書": "Description"}
+
+    with open(glossary_file, "w", encoding="utf-8") as f:
+        f.write("明細書\tSpecification\n技術分野\tTechnical Field\n")
+    expected = {"明細書": "Specification", "技術分野": "Technical Field"}
+    assert translate.load_glossary_entries(glossary_file) == expected
+
+
+@pytest.mark.parametrize(
+    'user_input,expected', [
+
+        # Success cases
+
+        # Docx files added to the queue.
+        (['translate.py', 'queue', 'jobs.db', 'tmx', 'a.docx', 'b.docx'],
+         (True, 'queue', 'jobs.db', 'tmx', ['a.docx', 'b.docx'], None)),
+        # Docx files added to the queue with a glossary.
+        (['translate.py', 'queue', 'jobs.db', 'docx', 'a.docx', 'glossary.txt'],
+         (True, 'queue', 'jobs.db', 'docx', ['a.docx'], 'glossary.txt')),
+        # Worker.
+        (['translate.py', 'worker', 'jobs.db'], (True, 'worker', 'jobs.db', None, None, None)),
+
+        # Failure cases
+
+        # No queue file given.
+        (['translate.py', 'worker'], (False, None, None, None, None, None)),
+        # Too many args for worker.
+        (['translate.py', 'worker', 'jobs.db', 'a.docx'], (False, None, None, None, None, None)),
+        # No format given.
+        (['translate.py', 'queue', 'jobs.db', 'a.docx'], (False, None, None, None, None, None)),
+        # No docx files given.
+        (['translate.py', 'queue', 'jobs.db', 'tmx', 'glossary.txt'], (False, None, None, None, None, None)),
+        # Incorrect translation file type.
+        (['translate.py', 'queue', 'jobs.db', 'tmx', 'a.docx', 'b.pdf'], (False, None, None, None, None, None)),
+    ]
+)
+def test_queue_input_check(user_input, expected):
+    assert translate.check_queue_input(user_input) == expected
+
+
+def test_claim_job_leases_each_job_once(tmp_path):
+    connection = translate.open_job_queue(str(tmp_path / "jobs.db"))
+    translate.add_jobs(connection, "tmx", ["a.docx", "b.docx"], None)
+
+    job_1 = translate.claim_job(connection, "worker-1")
+    job_2 = translate.claim_job(connection, "worker-2")
+
+    assert job_1[1].endswith("a.docx")
+    assert job_2[1].endswith("b.docx")
+    assert translate.claim_job(connection, "worker-3") is None
+
+
+def test_claim_job_reclaims_expired_lease(tmp_path, monkeypatch):
+    connection = translate.open_job_queue(str(tmp_path / "jobs.db"))
+    translate.add_jobs(connection, "tmx", ["a.docx"], None)
+
+    monkeypatch.setattr(translate, "JOB_LEASE_SECONDS", -1)
+    job_1 = translate.claim_job(connection, "worker-1")
+    job_2 = translate.claim_job(connection, "worker-2")
+    assert job_1 == job_2
+
+    # The first worker no longer holds the lease, so cannot complete the job
+    translate.complete_job(connection, job_1[0], "worker-1", "a-translated.tmx")
+    status = connection.execute("SELECT status, worker FROM jobs").fetchone()
+    assert status == ("running", "worker-2")
+
+
+def test_fail_job_retries_until_max_attempts(tmp_path):
+    connection = translate.open_job_queue(str(tmp_path / "jobs.db"))
+    translate.add_jobs(connection, "tmx", ["a.docx"], None)
+
+    for attempt in range(translate.JOB_MAX_ATTEMPTS):
+        job = translate.claim_job(connection, "worker-1")
+        assert job is not None
+        translate.fail_job(connection, job[0], "worker-1", "error")
+
+    assert translate.claim_job(connection, "worker-1") is None
+    status = connection.execute("SELECT status, attempts FROM jobs").fetchone()
+    assert status == ("failed", translate.JOB_MAX_ATTEMPTS)
+
+
+def test_run_worker(tmp_path, monkeypatch, mock_deepl_translator):
+    monkeypatch.chdir(tmp_path)
+    queue_file = str(tmp_path / "jobs.db")
+    connection = translate.open_job_queue(queue_file)
+    source_file = str(tmp_path / "test-source-text.docx")
+    Document(BASE_DIR + "/docs/test-source-text.docx").save(source_file)
+    translate.add_jobs(connection, "tmx", [source_file, "missing.docx"], None)
+
+    translate.run_worker(queue_file, mock_deepl_translator)
+
+    jobs = connection.execute("SELECT status, result FROM jobs ORDER BY id").fetchall()
+    assert jobs[0] == ("done", str(tmp_path / "test-source-text-translated.tmx"))
+    assert jobs[1][0] == "failed"
+    assert os.path.exists(tmp_path / "test-source-text-translated.tmx") is True
+
+
+def test_run_worker_saves_output_next_to_source_file(tmp_path, monkeypatch, mock_deepl_translator):
+    monkeypatch.chdir(tmp_path)
+    queue_file = str(tmp_path / "jobs.db")
+    connection = translate.open_job_queue(queue_file)
+    source_files = []
+    for directory in ("a", "b"):
+        os.mkdir(tmp_path / directory)
+        source_file = str(tmp_path / directory / "source.docx")
+        document = Document()
+        document.add_paragraph("技術分野")
+        document.save(source_file)
+        source_files.append(source_file)
+    translate.add_jobs(connection, "tmx", source_files, None)
+
+    translate.run_worker(queue_file, mock_deepl_translator)
+
+    results = connection.execute("SELECT result FROM jobs ORDER BY id").fetchall()
+    assert results == [
+        (str(tmp_path / "a" / "source-translated.tmx"),),
+        (str(tmp_path / "b" / "source-translated.tmx"),),
+    ]
+    assert os.path.exists(tmp_path / "a" / "source-translated.tmx") is True
+    assert os.path.exists(tmp_path / "b" / "source-translated.tmx") is True
+
+
+def test_job_heartbeat_keeps_running_after_error(tmp_path, monkeypatch):
+    queue_file = str(tmp_path / "jobs.db")
+    renewals = []
+
+    def renew_job_lease(connection, job_id, worker_id):
+        renewals.append(job_id)
+        if len(renewals) == 1:
+            raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(translate, "JOB_HEARTBEAT_SECONDS", 0.01)
+    monkeypatch.setattr(translate, "renew_job_lease", renew_job_lease)
+    stop = translate.start_job_heartbeat(queue_file, 1, "worker-1")
+    for _ in range(200):
+        if len(renewals) >= 3:
+            break
+        time.sleep(0.01)
+    stop.set()
+
+    assert len(renewals) >= 3
+
+
+def test_get_source_segments_from_bytes_and_stream(list_of_segment_objects_from_file):
+    expected = [segment.source_text for segment in list_of_segment_objects_from_file]
+    with open(BASE_DIR + "/docs/test-source-text.docx", "rb") as f:
+        source_bytes = f.read()
+        f.seek(0)
+        segments_from_stream = translate.get_source_segments(f)
+    segments_from_bytes = translate.get_source_segments(source_bytes)
+    assert [segment.source_text for segment in segments_from_bytes] == expected
+    assert [segment.source_text for segment in segments_from_stream] == expected
+
+
+def test_translate_docx_returns_tmx_bytes(mock_deepl_translator):
+    with open(BASE_DIR + "/docs/test-source-text.docx", "rb") as f:
+        output = translate.translate_docx(mock_deepl_translator, f.read(), "tmx")
+    assert isinstance(output, bytes)
+    content = output.decode("utf-8")
+    assert content.startswith('<?xml version="1.0" encoding="UTF-8"?>')
+    assert "<seg>本技術は、自己位置を推定する情報処理装置等の技術に関する。</seg>" in content
+    assert "<seg>mock_target_string_without_glossary</seg>" in content
+    assert "<seg>[0001]</seg>" in content
+
+
+def test_translate_docx_writes_docx_to_stream(mock_deepl_translator):
+    output = io.BytesIO()
+    with open(BASE_DIR + "/docs/test-source-text.docx", "rb") as f:
+        result = translate.translate_docx(mock_deepl_translator, f, "docx", output=output)
+    assert result is None
+    output.seek(0)
+    table = Document(output).tables[0]
+    assert len(table.rows) == 24
+    assert table.rows[0].cells[1].text == "mock_target_string_without_glossary"
+
+
+def test_translate_docx_rejects_text_stream_without_buffer(mock_deepl_translator):
+    with pytest.raises(TypeError):
+        translate.translate_docx(mock_deepl_translator, b"", "tmx", output=io.StringIO())
+
+
+def test_find_glossary_terms(mock_glossary_entries):
+    matcher = translate.compile_glossary_matcher(mock_glossary_entries)
+    text = "発明の概要：表示部と制御部、及び表示部。発明が解決しようとする課題"
+    assert translate.find_glossary_terms(matcher, mock_glossary_entries, text) == [
+        "発明の概要",
+        "表示部",
+        "制御部",
+        "発明が解決しようとする課題",
+    ]
+
+
+def test_check_glossary_compliance(mock_glossary_entries):
+    segments = [
+        Segment(source_text="技術分野", target_text="Technical field"),
+        Segment(source_text="表示部と制御部", target_text="the display unit and controller"),
+        Segment(source_text="情報処理装置の表示部", target_text="the screen of the device"),
+        Segment(source_text="", target_text=""),
+    ]
+    issues = translate.check_glossary_compliance(segments, mock_glossary_entries)
+    assert issues == [
+        (1, "制御部", "control unit"),
+        (2, "情報処理装置", "information processing device"),
+        (2, "表示部", "display unit"),
+    ]
+
+
+def test_translate_document_resends_segments_missing_glossary_terms(tmp_path, monkeypatch, mock_deepl_translator):
+    monkeypatch.chdir(tmp_path)
+    sent_texts = []
+
+    def translate_text(source_text, source_lang, target_lang, glossary):
+        sent_texts.append(source_text)
+        if source_text == "技術分野":
+            return "Technical Field"
+        return "mock_target_string_with_glossary"
+
+    mock_deepl_translator.translate_text = translate_text
+    source_file = BASE_DIR + "/docs/test-source-text.docx"
+    glossary_file = BASE_DIR + "/docs/test-glossary-1.txt"
+    monkeypatch.setattr(translate, "load_glossary_entries", translate.extract_glossary_entries)
+
+    translate.translate_document(mock_deepl_translator, "tmx", source_file, glossary_file, resend=True)
+
+    # 18 segments are translated, then the 15 containing glossary terms other
+    # than "技術分野" are translated again.
+    assert len(sent_texts) == 33
+    assert sent_texts.count("技術分野") == 1
+    with open("test-source-text-translated-glossary-check.txt", encoding="utf-8") as f:
+        report = f.read()
+    assert report.startswith("Segments missing glossary terms: ")
+    assert '"明細書" should be translated as "Description"' in report
+
+
+def mock_deepl_async_client(requests_made, delay=0):
+    async def handler(request):
+        if request.method == "DELETE":
+            requests_made.append(("DELETE", request.url.path))
+            return httpx.Response(204)
+        data = {key: value[0] for key, value in parse_qs(request.content.decode()).items()}
+        requests_made.append(("POST", data))
+        await asyncio.sleep(delay)
+        text = "translated " + data["text"]
+        return httpx.Response(200, json={"translations": [{"detected_source_language": "JA", "text": text}]})
+
+    return httpx.AsyncClient(base_url="https://api-free.deepl.com", transport=httpx.MockTransport(handler))
+
+
+async def collect_segments_async(client, segments, glossary, **kwargs):
+    translated_segments = []
+    try:
+        async for segment in translate.translate_segments_async(client, segments, glossary, **kwargs):
+            translated_segments.append(segment)
+    finally:
+        await client.aclose()
+    return translated_segments
+
+
+def test_setup_deepl_async_client_server_url():
+    assert str(translate.setup_deepl_async_client("key:fx").base_url) == "https://api-free.deepl.com"
+    assert str(translate.setup_deepl_async_client("key").base_url) == "https://api.deepl.com"
+
+
+def test_translate_segments_async(list_of_segment_objects):
+    requests_made = []
+    client = mock_deepl_async_client(requests_made)
+    list_of_segment_objects[3].source_text = ""
+
+    segments = asyncio.run(collect_segments_async(client, list_of_segment_objects, None))
+
+    assert segments == list_of_segment_objects
+    assert len(requests_made) == 9
+    assert segments[3].target_text == ""
+    assert segments[0].target_text == "translated 正孔輸送層12は、無機材料を含む。"
+    assert requests_made[0][1]["target_lang"] == "EN-US"
+
+
+def test_translate_segments_async_with_glossary(list_of_segment_objects):
+    requests_made = []
+    client = mock_deepl_async_client(requests_made)
+    glossary = Mock()
+    glossary.glossary_id = "glossary-id"
+
+    asyncio.run(collect_segments_async(client, list_of_segment_objects, glossary))
+
+    assert all(data["glossary_id"] == "glossary-id" for method, data in requests_made[:-1])
+    assert requests_made[-1] == ("DELETE", "/v2/glossaries/glossary-id")
+
+
+def test_translate_segments_async_timeout(list_of_segment_objects):
+    requests_made = []
+    client = mock_deepl_async_client(requests_made, delay=1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(collect_segments_async(client, list_of_segment_objects, None, max_requests=2, timeout=0.1))
+
+    # Only the first requests were sent before the remaining ones were cancelled
+    assert len(requests_made) == 2
+
+
+def test_translate_segments_async_cancelled_when_glossary_delete_fails(list_of_segment_objects):
+    async def handler(request):
+        if request.method == "DELETE":
+            raise httpx.ConnectError("Connection refused", request=request)
+        await asyncio.sleep(1)
+
+    client = httpx.AsyncClient(base_url="https://api-free.deepl.com", transport=httpx.MockTransport(handler))
+    glossary = Mock()
+    glossary.glossary_id = "glossary-id"
+
+    async def cancel_job():
+        task = asyncio.ensure_future(collect_segments_async(client, list_of_segment_objects, glossary))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return task.cancelled()
+
+    assert asyncio.run(cancel_job()) is True
+
+
+@pytest.mark.parametrize(
+    'user_input,expected', [
+        (['translate.py', 'import', 'memory.db', 'a.tmx', 'b.tmx'], (True, 'memory.db', ['a.tmx', 'b.tmx'])),
+        (['translate.py', 'import', 'memory.db'], (False, None, None)),
+        (['translate.py', 'import', 'memory.db', 'a.docx'], (False, None, None)),
+    ]
+)
+def test_import_input_check(user_input, expected):
+    assert translate.check_import_input(user_input) == expected
+
+
+def test_read_tmx_units(tmp_path):
+    tmx_file = str(tmp_path / "memory.tmx")
+    with open(tmx_file, "w", encoding="utf-8") as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<tmx version="1.4"><header srclang="ja-JP"/><body>\n'
+            '<tu><tuv xml:lang="ja-JP"><seg>技術分野</seg></tuv>'
+            '<tuv xml:lang="en-US"><seg>Technical Field</seg></tuv></tu>\n'
+            '<tu><tuv xml:lang="ja-JP"><seg>背景技術</seg></tuv>'
+            '<tuv xml:lang="de-DE"><seg>Stand der Technik</seg></tuv></tu>\n'
+            '<tu><tuv lang="JA"><seg>表示部<bpt i="1">&lt;b&gt;</bpt>３</seg></tuv>'
+            '<tuv lang="EN-US"><seg>display unit 3</seg></tuv></tu>\n'
+            '</body></tmx>\n'
+        )
+    units = list(translate.read_tmx_units(tmx_file))
+    assert units == [("技術分野", "Technical Field"), ("表示部<b>３", "display unit 3")]
+
+
+def test_import_tmx(tmp_path, monkeypatch, list_of_translated_segment_objects):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(translate, "TMX_IMPORT_BATCH_SIZE", 3)
+    list_of_translated_segment_objects[0].source_text = "技術分野"
+    list_of_translated_segment_objects[0].target_text = "Technical Field"
+    tmx_file = translate.create_tmx("memory", list_of_translated_segment_objects)
+
+    memory = translate.open_translation_memory(str(tmp_path / "memory.db"))
+    assert translate.import_tmx(memory, tmx_file) == 10
+    assert memory.execute("SELECT COUNT(*) FROM memory").fetchone() == (2,)
+
+    segments = [
+        Segment(source_text="技術分野", target_text=""),
+        Segment(source_text="背景技術", target_text=""),
+    ]
+    pending_segments = translate.apply_translation_memory(memory, segments)
+    assert pending_segments == [segments[1]]
+    assert segments[0].target_text == "Technical Field"
+
+
+def test_import_tmx_with_escaped_text(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    segments = [Segment(source_text="研究開発部", target_text="R&D <department>")]
+    tmx_file = translate.create_tmx("memory", segments)
+
+    memory = translate.open_translation_memory(str(tmp_path / "memory.db"))
+    assert translate.import_tmx(memory, tmx_file) == 1
+    assert memory.execute("SELECT * FROM memory").fetchall() == [
+        ("研究開発部", "R&D <department>")
+    ]
+    assert translate.get_previous_segments(tmx_file)[0].target_text == "R&D <department>"
+
+
+def test_import_tmx_with_unescaped_text(tmp_path):
+    # As written by earlier versions of create_tmx()
+    tmx_file = str(tmp_path / "legacy.tmx")
+    with open(tmx_file, "w", encoding="utf-8") as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<tmx version="1.1">\n'
+            "  <body>\n"
+            '    <tu>\n      <tuv lang="JA">\n        <seg>研究開発部</seg>\n      </tuv>\n'
+            '      <tuv lang="EN-US">\n        <seg>R&D department</seg>\n      </tuv>\n    </tu>\n'
+            '    <tu>\n      <tuv lang="JA">\n        <seg>a<b</seg>\n      </tuv>\n'
+            '      <tuv lang="EN-US">\n        <seg>a &lt; b</seg>\n      </tuv>\n    </tu>\n'
+            "  </body>\n"
+            "</tmx>\n"
+        )
+
+    memory = translate.open_translation_memory(str(tmp_path / "memory.db"))
+    assert translate.import_tmx(memory, tmx_file) == 2
+    assert memory.execute("SELECT * FROM memory ORDER BY source_text").fetchall() == [
+        ("a<b", "a < b"),
+        ("研究開発部", "R&D department"),
+    ]
+
+
+def test_import_tmx_not_well_formed(tmp_path):
+    tmx_file = str(tmp_path / "broken.tmx")
+    with open(tmx_file, "w", encoding="utf-8") as f:
+        f.write("<tmx><body><tu>")
+
+    memory = translate.open_translation_memory(str(tmp_path / "memory.db"))
+    with pytest.raises(translate.ET.ParseError):
+        translate.import_tmx(memory, tmx_file)
+
+
+def test_translate_document_with_translation_memory(tmp_path, monkeypatch, mock_deepl_translator):
+    monkeypatch.chdir(tmp_path)
+    memory_file = str(tmp_path / "memory.db")
+    memory = translate.open_translation_memory(memory_file)
+    translate.save_to_translation_memory(memory, [Segment(source_text="明細書", target_text="Description")])
+    memory.close()
+    source_file = BASE_DIR + "/docs/test-source-text.docx"
+
+    translate.translate_document(mock_deepl_translator, "tmx", source_file, None, memory_file=memory_file)
+    memory = translate.open_translation_memory(memory_file)
+    assert memory.execute("SELECT COUNT(*) FROM memory").fetchone() == (18,)
+
+    # All segments are now found in the translation memory
+    def fail(*args, **kwargs):
+        raise AssertionError("segment sent to DeepL")
+
+    mock_deepl_translator.translate_text = fail
+    translate.translate_document(mock_deepl_translator, "tmx", source_file, None, memory_file=memory_file)
+    segments = translate.get_previous_segments("test-source-text-translated.tmx")
+    assert segments[0].target_text == "Description"
+    assert segments[2].target_text == "mock_target_string_without_glossary"
+
+
+def test_translate_document_saves_resent_segments_to_translation_memory(tmp_path, monkeypatch, mock_deepl_translator):
+    monkeypatch.chdir(tmp_path)
+    memory_file = str(tmp_path / "memory.db")
+    memory = translate.open_translation_memory(memory_file)
+    translate.save_to_translation_memory(memory, [Segment(source_text="技術分野", target_text="Field")])
+    memory.close()
+    sent_texts = []
+
+    def translate_text(source_text, source_lang, target_lang, glossary):
+        sent_texts.append(source_text)
+        if source_text == "技術分野":
+            return "Technical Field"
+        return "mock_target_string_with_glossary"
+
+    mock_deepl_translator.translate_text = translate_text
+    source_file = BASE_DIR + "/docs/test-source-text.docx"
+    glossary_file = BASE_DIR + "/docs/test-glossary-1.txt"
+    monkeypatch.setattr(translate, "load_glossary_entries", translate.extract_glossary_entries)
+
+    translate.translate_document(
+        mock_deepl_translator, "tmx", source_file, glossary_file, resend=True, memory_file=memory_file
+    )
+
+    # The segment from the translation memory lacked its glossary term, so
+    # was translated again, and the new translation replaces the old one.
+    assert sent_texts.count("技術分野") == 1
+    segments = translate.get_previous_segments("test-source-text-translated.tmx")
+    assert segments[2].target_text == "Technical Field"
+    memory = translate.open_translation_memory(memory_file)
+    assert memory.execute(
+        "SELECT target_text FROM memory WHERE source_text = ?", ("技術分野",)
+    ).fetchone() == ("Technical Field",)
+
+
+@pytest.mark.parametrize(
+    'text,expected', [
+        ('', ['']),
+        ('Description', ['Description']),
+        ('The unit is shown in FIG. 1. It may also be used. (See FIGS. 2 and 3.)',
+         ['The unit is shown in FIG. 1.', 'It may also be used.', '(See FIGS. 2 and 3.)']),
+        ('Is it? Yes! 3.5 mm is e.g. 0.1 in.', ['Is it?', 'Yes!', '3.5 mm is e.g. 0.1 in.']),
+    ]
+)
+def test_split_target_paragraph(text, expected):
+    assert translate.split_target_paragraph(text) == expected
+
+
+def test_align_by_length():
+    source_texts = ["あ" * 10, "い" * 40, "う" * 30]
+    target_texts = ["A" * 25, "B" * 50, "C" * 48, "D" * 75]
+    assert translate.align_by_length(source_texts, target_texts) == [
+        (["あ" * 10], ["A" * 25]),
+        (["い" * 40], ["B" * 50, "C" * 48]),
+        (["う" * 30], ["D" * 75]),
+    ]
+
+
+def test_align_document():
+    source_paragraphs = [
+        "技術分野",
+        "表示部３は、グラス部１５の表面に設けられている。なお、表示部３は、非シースルータイプの表示部であってもよい。",
+        "",
+    ]
+    target_paragraphs = [
+        "Technical Field",
+        "The display unit 3 is provided on the surface of the glass unit 15, and may be a non-see-through display unit.",
+        "",
+    ]
+    segments = translate.align_document(source_paragraphs, target_paragraphs)
+    assert [(segment.source_text, segment.target_text) for segment in segments] == [
+        ("技術分野", "Technical Field"),
+        (source_paragraphs[1], target_paragraphs[1]),
+        ("", ""),
+    ]
+
+
+class MockDeeplDocumentTranslator(MockDeeplTranslator):
+    def __init__(self, target_paragraphs):
+        super().__init__()
+        self.target_paragraphs = target_paragraphs
+        self.status_checks = 0
+
+    def translate_document_upload(self, input_document, source_lang, target_lang, glossary, filename):
+        return "handle"
+
+    def translate_document_get_status(self, handle):
+        self.status_checks += 1
+        status = Mock()
+        status.ok = True
+        status.done = self.status_checks == 2
+        status.seconds_remaining = 0
+        return status
+
+    def translate_document_download(self, handle, output_file):
+        document = Document()
+        for para in self.target_paragraphs:
+            document.add_paragraph(para)
+        document.save(output_file)
+
+
+def test_translate_whole_document(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(translate.time, "sleep", lambda seconds: None)
+    source_file = str(tmp_path / "source.docx")
+    document = Document()
+    document.add_paragraph("技術分野")
+    document.add_paragraph("本技術は、情報処理装置に関する。表示部は、非シースルータイプであってもよい。")
+    document.save(source_file)
+    translator = MockDeeplDocumentTranslator([
+        "Technical Field",
+        "The present technology relates to an information processing device. "
+        "The display unit may be a non-see-through type.",
+    ])
+
+    output_file = translate.translate_whole_document(translator, "tmx", source_file, None)
+
+    assert output_file == "source-translated.tmx"
+    assert translator.status_checks == 2
+    segments = translate.get_previous_segments(output_file)
+    assert [(segment.source_text, segment.target_text) for segment in segments] == [
+        ("技術分野", "Technical Field"),
+        ("本技術は、情報処理装置に関する。", "The present technology relates to an information processing device."),
+        ("表示部は、非シースルータイプであってもよい。", "The display unit may be a non-see-through type."),
+    ]
+
+
+def test_translate_whole_document_failed(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    glossary_file = str(tmp_path / "glossary.txt")
+    with open(glossary_file, "w", encoding="utf-8") as f:
+        f.write("技術分野\tTechnical Field\n")
+    translator = MockDeeplDocumentTranslator([])
+    translator.delete_glossary = Mock()
+    status = Mock(ok=False, error_message="Source document is corrupted")
+    translator.translate_document_get_status = Mock(return_value=status)
+    source_file = BASE_DIR + "/docs/test-source-text.docx"
+
+    with pytest.raises(SystemExit):
+        translate.translate_whole_document(translator, "tmx", source_file, glossary_file)
+
+    translator.delete_glossary.assert_called_once()
+    assert "Source document is corrupted" in capsys.readouterr().out
+
+
+def test_align_by_length_large_document():
+    source_texts = ["本" * (10 + i % 50) for i in range(1000)]
+    target_texts = ["x" * (20 + i % 100) for i in range(1000)]
+    target_texts.insert(500, "x" * 30)
+
+    alignment = translate.align_by_length(source_texts, target_texts)
+
+    assert sum(len(sources) for sources, _ in alignment) == 1000
+    assert sum(len(targets) for _, targets in alignment) == 1001
+    assert alignment[0] == (source_texts[:1], target_texts[:1])
+    assert alignment[-1] == (source_texts[-1:], target_texts[-1:])
+
+
+def test_translate_whole_document_checks_minimum_billed_characters(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    translator = MockDeeplDocumentTranslator([])
+    translator.usage.character.count = 460000
+    source_file = BASE_DIR + "/docs/test-source-text.docx"
+    assert translate.translate_whole_document(translator, "tmx", source_file, None) is None
+
+
+def test_translate_document_with_profiler(tmp_path, monkeypatch, mock_deepl_translator):
+    monkeypatch.chdir(tmp_path)
+    source_file = BASE_DIR + "/docs/test-source-text.docx"
+    profiler = translate.Profiler()
+
+    translate.translate_document(mock_deepl_translator, "tmx", source_file, None, profiler=profiler)
+    summary_file = profiler.save("test-source-text-translated")
+
+    assert [stage[0] for stage in profiler.stages] == ["extraction", "glossary", "translation", "writing"]
+    assert os.path.exists("test-source-text-translated.prof") is True
+    with open(summary_file, encoding="utf-8") as f:
+        summary = f.read()
+    assert "Stage: extraction" in summary
+    assert "Peak memory: " in summary
+    assert "Functions by cumulative time:" in summary
+
+
+def test_profile_stage_without_profiler():
+    with translate.profile_stage(None, "extraction"):
+        pass
+
+
+@pytest.mark.parametrize(
+    'cache_content', [
+        '[1, 2, 3]',
+        '{"size": 10, "hash": "", "entries": {}}',
+        '{"mtime": 1, "size": 10, "hash": "", "entries": {"明細書": 1}}',
+        'not json',
+    ]
+)
+def test_load_glossary_entries_ignores_invalid_cache(tmp_path, cache_content):
+    glossary_file = str(tmp_path / "glossary.txt")
+    with open(glossary_file, "w", encoding="utf-8") as f:
+        f.write("明細書\tDescription\n")
+    with open(glossary_file + ".cache", "w", encoding="utf-8") as f:
+        f.write(cache_content)
+
+    assert translate.load_glossary_entries(glossary_file) == {"明細書": "Description"}
+    assert translate.read_glossary_cache(glossary_file + ".cache")["entries"] == {"明細書": "Description"}
+    assert sorted(os.listdir(tmp_path)) == ["glossary.txt", "glossary.txt.cache"]
+
+
+def test_translate_text_async_does_not_sleep_after_last_attempt(monkeypatch):
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+
+    async def handler(request):
+        return httpx.Response(429, text="Too many requests")
+
+    async def translate_text():
+        async with httpx.AsyncClient(base_url="https://api-free.deepl.com", transport=httpx.MockTransport(handler)) as client:
+            await translate.translate_text_async(client, "技術分野", None)
+
+    monkeypatch.setattr(translate.asyncio, "sleep", sleep)
+    with pytest.raises(deepl.DeepLException):
+        asyncio.run(translate_text())
+    assert sleeps == [1, 2, 4, 8]
+
+
+def test_translate_segments_async_aclose_cancels_requests(list_of_segment_objects):
+    requests_made = []
+    client = mock_deepl_async_client(requests_made, delay=0.05)
+
+    async def translate_first_segment():
+        async with contextlib.aclosing(
+            translate.translate_segments_async(client, list_of_segment_objects, None, max_requests=2)
+        ) as results:
+            async for segment in results:
+                break
+        await client.aclose()
+
+    asyncio.run(translate_first_segment())
+    assert len(requests_made) < len(list_of_segment_objects)
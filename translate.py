@@ -1,20 +1,188 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import contextlib
+import cProfile
+import difflib
+import hashlib
+import io
+import itertools
+import json
+import math
 import os
+import pstats
+import re
+import socket
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import unicodedata
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, unescape
 
 import deepl
+import httpx
 from environs import Env
 from docx import Document
 
 
+# Patterns for segments that need no machine translation. These are matched
+# against the width-normalized (NFKC) segment text.
+PARAGRAPH_LABEL_PATTERN = re.compile(r"[【\[](\d+)[】\]]")
+FIGURE_REFERENCE_PATTERN = re.compile(
+    r"【図\s*(\d+(?:[A-Za-z]|\([A-Za-z]\))?)】"
+    r"|\[図\s*(\d+(?:[A-Za-z]|\([A-Za-z]\))?)\]"
+    r"|図\s*(\d+(?:[A-Za-z]|\([A-Za-z]\))?)"
+)
+NUMBER_OR_FORMULA_PATTERN = re.compile(
+    r"(?=.*\d)(?:(?<![A-Za-z])[A-Za-z](?![A-Za-z])|[\d\s.,%+\-−×÷*/=<>≦≧≤≥()^])+"
+)
+CHEMICAL_NOTATION_PATTERN = re.compile(r"(?:[A-Z][a-z]?\d*|[()\[\]·+\-]\d*)+")
+
+# Circled numbers (① to ⑳) are list markers, so are converted to "(1)" etc.
+# rather than to the bare digits NFKC would give.
+CIRCLED_NUMBERS = {0x2460 + i: "(" + str(i + 1) + ")" for i in range(20)}
+
+# A job claimed by a worker is handed to another worker if its lease is not
+# renewed (by the heartbeat) within JOB_LEASE_SECONDS. A job that fails is
+# retried until it has been attempted JOB_MAX_ATTEMPTS times.
+JOB_LEASE_SECONDS = 120
+JOB_HEARTBEAT_SECONDS = 30
+JOB_MAX_ATTEMPTS = 3
+
+# Target text sentence boundaries, and abbreviations after which a sentence
+# does not end.
+TARGET_SENTENCE_BOUNDARY_PATTERN = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\"'(\[])")
+TARGET_ABBREVIATIONS = ("FIG.", "FIGS.", "Fig.", "Figs.", "No.", "Nos.", "e.g.", "i.e.")
+
+# Probabilities of each way of aligning source and target sentences in the
+# length-based alignment, as (source count, target count): probability, and
+# the variance of the target length per source character (from Gale and
+# Church, "A Program for Aligning Sentences in Bilingual Corpora", 1993).
+# ALIGNMENT_BAND is how far, beyond the difference in the numbers of texts,
+# an alignment may stray from the diagonal.
+ALIGNMENT_PRIORS = {
+    (1, 1): 0.89,
+    (1, 0): 0.0099 / 2,
+    (0, 1): 0.0099 / 2,
+    (2, 1): 0.089 / 2,
+    (1, 2): 0.089 / 2,
+    (2, 2): 0.011,
+}
+ALIGNMENT_VARIANCE = 6.8
+ALIGNMENT_BAND = 20
+
+# How often the status of a whole-document translation is checked, and the
+# minimum number of characters DeepL bills for each document translation.
+DOCUMENT_POLL_SECONDS = 5
+DOCUMENT_MIN_BILLED_CHARACTERS = 50000
+
+# Number of allocation sites and functions listed for each stage in the
+# summary written by the "--profile" option.
+PROFILE_TOP_ALLOCATIONS = 10
+PROFILE_TOP_FUNCTIONS = 30
+
+# Number of translation units inserted per transaction when importing tmx
+# files into a translation memory.
+TMX_IMPORT_BATCH_SIZE = 50000
+TMX_READ_CHUNK_SIZE = 1 << 20
+
+# Matches the text of a seg written on a single line, as create_tmx() does
+TMX_SEG_PATTERN = re.compile(r"(<seg>)(.*?)(</seg>)")
+
+# Number of requests kept in flight at a time by translate_segments_async(),
+# and number of attempts made when DeepL is busy.
+ASYNC_MAX_REQUESTS = 8
+ASYNC_MAX_ATTEMPTS = 5
+
+
 class Segment:
     def __init__(self, source_text, target_text):
         self.source_text = source_text
         self.target_text = target_text
 
 
+class Profiler:
+    """
+    Records the CPU time (with cProfile) and memory use (with tracemalloc) of
+    each stage of the pipeline.
+    """
+
+    def __init__(self):
+        self.cpu_profile = cProfile.Profile()
+        self.stages = []
+        tracemalloc.start()
+
+    @staticmethod
+    def take_snapshot():
+        # Leave out the memory used by tracemalloc itself
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        tracemalloc.reset_peak()
+        snapshot = self.take_snapshot()
+        start_time = time.perf_counter()
+        self.cpu_profile.enable()
+
+        try:
+            yield
+        finally:
+            self.cpu_profile.disable()
+            seconds = time.perf_counter() - start_time
+            _, peak_memory = tracemalloc.get_traced_memory()
+            top_allocations = self.take_snapshot().compare_to(snapshot, "lineno")[
+                :PROFILE_TOP_ALLOCATIONS
+            ]
+            self.stages.append((name, seconds, peak_memory, top_allocations))
+
+    def save(self, profile_name):
+        """
+        Saves the cProfile data, which can be opened with pstats or tools like
+        snakeviz, and a summary of each stage as a text file.
+        Returns the name of the summary file.
+        """
+
+        tracemalloc.stop()
+
+        profile_file = profile_name + ".prof"
+        summary_file = profile_name + "-profile.txt"
+
+        self.cpu_profile.dump_stats(profile_file)
+
+        with open(summary_file, "w", encoding="utf-8") as f:
+            for name, seconds, peak_memory, top_allocations in self.stages:
+                f.write(
+                    "Stage: "
+                    + name
+                    + "\n"
+                    + "  Time: "
+                    + format(seconds, ".2f")
+                    + " s\n"
+                    + "  Peak memory: "
+                    + format(peak_memory / 1000000, ".1f")
+                    + " MB\n"
+                    + "  Top allocations:\n"
+                )
+                for allocation in top_allocations:
+                    f.write("    " + str(allocation) + "\n")
+                f.write("\n")
+
+            f.write("Functions by cumulative time:\n")
+            stats = pstats.Stats(self.cpu_profile, stream=f)
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+
+        print('Profile saved as "' + profile_file + '" and "' + summary_file + '".')
+
+        return summary_file
+
+
 def check_user_input(user_input):
     format_message = (
         "Expected input:\n"
@@ -58,48 +226,711 @@ def check_user_input(user_input):
     return True, output_format, translation_file, glossary_file
 
 
-def setup_deepl_translator():
+def check_user_options(user_input):
+    """
+    Separates the optional "--" arguments from the positional arguments
+    that are then checked by check_user_input().
+    Returns whether the options are valid, the remaining positional
+    arguments, and a dict of the option values.
+    """
+
+    format_message = (
+        "Available options:\n"
+        "  --previous previous-translated.tmx/docx  "
+        "Only translate segments that have changed since a previous translation.\n"
+        "  --resend  "
+        "Translate again segments in which glossary terms were not used.\n"
+        "  --memory memory.db  "
+        "Reuse and save translations in a translation memory.\n"
+        "  --document  "
+        "Upload the whole document to DeepL in one request "
+        '(cannot be used with "--previous" or "--memory").\n'
+        "  --profile  "
+        "Save CPU and memory profiles of each stage next to the output."
+    )
+
+    options = {
+        "--previous": None,
+        "--resend": False,
+        "--memory": None,
+        "--document": False,
+        "--profile": False,
+    }
+    positional_args = []
+
+    args = iter(user_input)
+    for arg in args:
+        if not arg.startswith("--"):
+            positional_args.append(arg)
+            continue
+
+        if arg not in options:
+            print('Error: Unknown option "' + arg + '".')
+            print(format_message)
+            return False, None, None
+
+        if arg in ("--resend", "--document", "--profile"):
+            options[arg] = True
+            continue
+
+        value = next(args, None)
+
+        # "--previous" should be followed by a tmx or docx file
+        if arg == "--previous" and (
+            value is None or not value.lower().endswith((".tmx", ".docx"))
+        ):
+            print('Error: "--previous" should be followed by a tmx or docx file.')
+            print(format_message)
+            return False, None, None
+
+        # "--memory" should be followed by the translation memory file
+        if arg == "--memory" and (value is None or value.startswith("--")):
+            print('Error: "--memory" should be followed by a translation memory file.')
+            print(format_message)
+            return False, None, None
+
+        options[arg] = value
+
+    # Segments cannot be reused when the whole document is translated
+    if options["--document"] and (options["--previous"] or options["--memory"]):
+        print(
+            'Error: "--document" cannot be used with "--previous" or "--memory".'
+        )
+        print(format_message)
+        return False, None, None
+
+    return True, positional_args, options
+
+
+def check_queue_input(user_input):
+    format_message = (
+        "Expected input:\n"
+        "  python translate.py queue jobs.db tmx/docx translation.docx ... glossary.txt\n"
+        "  python translate.py worker jobs.db\n"
+        "Any number of docx files can be added to the queue at once.\n"
+        "The glossary text file is optional."
+    )
+
+    # 2nd arg should be "queue" or "worker", and 3rd arg the queue file
+    if len(user_input) < 3 or user_input[1] not in ("queue", "worker"):
+        print("Error: Incorrect number of arguments.")
+        print(format_message)
+        return False, None, None, None, None, None
+
+    command = user_input[1]
+    queue_file = user_input[2]
+
+    if command == "worker":
+        if len(user_input) != 3:
+            print("Error: Incorrect number of arguments.")
+            print(format_message)
+            return False, None, None, None, None, None
+        return True, command, queue_file, None, None, None
+
+    # 4th arg should be "tmx" or "docx" specifying the output format
+    if len(user_input) < 5 or user_input[3] not in ("tmx", "docx"):
+        print(
+            'Error: Fourth argument should be "tmx" or "docx" specifying the output format.'
+        )
+        print(format_message)
+        return False, None, None, None, None, None
+    output_format = user_input[3]
+
+    # Last arg, if a txt file, is the glossary
+    source_files = user_input[4:]
+    if source_files[-1].lower().endswith(".txt"):
+        glossary_file = source_files.pop()
+    else:
+        glossary_file = None
+
+    # Remaining args should be docx files
+    if not source_files or not all(
+        source_file.lower().endswith(".docx") for source_file in source_files
+    ):
+        print("Error: The files to be translated should be docx files.")
+        print(format_message)
+        return False, None, None, None, None, None
+
+    return True, command, queue_file, output_format, source_files, glossary_file
+
+
+def get_deepl_auth_key():
     env = Env()
     env.read_env()
-    auth_key = env.str("AUTH_KEY")
+    return env.str("AUTH_KEY")
+
+
+def check_import_input(user_input):
+    format_message = (
+        "Expected input:\n"
+        "  python translate.py import memory.db translation.tmx ...\n"
+        "Any number of tmx files can be imported at once."
+    )
+
+    # Should be "import", the translation memory file, and at least one tmx file
+    if len(user_input) < 4 or user_input[1] != "import":
+        print("Error: Incorrect number of arguments.")
+        print(format_message)
+        return False, None, None
+
+    tmx_files = user_input[3:]
+    if not all(tmx_file.lower().endswith(".tmx") for tmx_file in tmx_files):
+        print("Error: The files to be imported should be tmx files.")
+        print(format_message)
+        return False, None, None
+
+    return True, user_input[2], tmx_files
+
+
+def setup_deepl_translator():
+    auth_key = get_deepl_auth_key()
     translator = deepl.Translator(auth_key)
     return translator
 
 
+def setup_deepl_async_client(auth_key, max_requests=ASYNC_MAX_REQUESTS):
+    """
+    Returns an httpx.AsyncClient for the DeepL API, for use with
+    translate_segments_async(). Connections are kept open and reused across
+    requests, so the same client should be shared by all jobs and closed with
+    "await client.aclose()" when no longer needed.
+    """
+
+    # Keys for the free API end with ":fx"
+    if auth_key.endswith(":fx"):
+        server_url = "https://api-free.deepl.com"
+    else:
+        server_url = "https://api.deepl.com"
+
+    return httpx.AsyncClient(
+        base_url=server_url,
+        headers={"Authorization": "DeepL-Auth-Key " + auth_key},
+        limits=httpx.Limits(
+            max_connections=max_requests, max_keepalive_connections=max_requests
+        ),
+        timeout=30,
+    )
+
+
 def get_source_segments(source_file):
     """
     Reads in text from user-specified docx file.
     File is already split into paragraphs by Document module.
     Text is further split into sentences if a paragraph contains multiple
     sentences.
+    The docx file can also be given as bytes or as a binary file-like object.
     """
 
-    print('Extracting text from "' + source_file + '".')
+    if isinstance(source_file, str):
+        print('Extracting text from "' + source_file + '".')
+    elif isinstance(source_file, (bytes, bytearray)):
+        source_file = io.BytesIO(source_file)
 
     document = Document(source_file)
     segments = []
 
     for para in document.paragraphs:
-        # Split again if paragraph contains multiple sentences.
-        if para.text.count("。") >= 2:
-            sentences = para.text.split("。")
-
-            for sentence in sentences:
-                # Add each single sentence to source_segments list.
-                # However, if "。" appears at the end of a string, split()
-                # creates an empty string representing the substring that
-                # follows "。". Using "if sentence" skips such empty strings.
-                # Also, split() removes the "。" delim, so have to add this.
-                if sentence:
-                    segment = Segment(source_text=sentence + "。", target_text="")
-                    segments.append(segment)
-        else:
-            segment = Segment(source_text=para.text, target_text="")
+        for sentence in split_source_paragraph(para.text):
+            segment = Segment(source_text=sentence, target_text="")
             segments.append(segment)
 
     return segments
 
 
+def split_source_paragraph(text):
+    """
+    Splits the text of a paragraph into sentences if it contains multiple
+    sentences.
+    """
+
+    # Split again if paragraph contains multiple sentences.
+    if text.count("。") < 2:
+        return [text]
+
+    # However, if "。" appears at the end of a string, split() creates an
+    # empty string representing the substring that follows "。". Using
+    # "if sentence" skips such empty strings.
+    # Also, split() removes the "。" delim, so have to add this.
+    return [sentence + "。" for sentence in text.split("。") if sentence]
+
+
+def split_target_paragraph(text):
+    """
+    Splits the text of a translated (English) paragraph into sentences.
+    """
+
+    sentences = []
+
+    for sentence in TARGET_SENTENCE_BOUNDARY_PATTERN.split(text.strip()):
+        # Rejoin sentences split after an abbreviation such as "FIG."
+        if sentences and sentences[-1].endswith(TARGET_ABBREVIATIONS):
+            sentences[-1] += " " + sentence
+        else:
+            sentences.append(sentence)
+
+    return sentences
+
+
+def get_previous_segments(previous_file):
+    """
+    Reads in the segments of a tmx or docx file previously output by
+    create_tmx() or create_docx().
+    Exits the program if there is an error when reading the file.
+    """
+
+    print('Reading previous translation from "' + previous_file + '".')
+
+    segments = []
+
+    try:
+        if previous_file.lower().endswith(".tmx"):
+            with open(previous_file, encoding="utf-8") as f:
+                content = f.read()
+            # create_tmx() writes each tu as a JA seg followed by an EN-US seg
+            seg_texts = re.findall(r"<seg>(.*?)</seg>", content, re.DOTALL)
+            for source_text, target_text in zip(seg_texts[::2], seg_texts[1::2]):
+                segment = Segment(
+                    source_text=unescape(source_text),
+                    target_text=unescape(target_text),
+                )
+                segments.append(segment)
+        else:
+            document = Document(previous_file)
+            for row in document.tables[0].rows:
+                segment = Segment(
+                    source_text=row.cells[0].text, target_text=row.cells[1].text
+                )
+                segments.append(segment)
+
+    except Exception as e:
+        print(
+            "An error occurred when reading your previous translation.\n"
+            "Error details:"
+        )
+        print(e)
+        sys.exit()
+
+    return segments
+
+
+def reuse_previous_translations(segments, previous_segments):
+    """
+    Aligns the source segments with those of a previous translation and
+    copies over the target text of every segment that is unchanged.
+    Returns the list of segments that were inserted or changed, and so
+    still need to be translated.
+    """
+
+    source_texts = [segment.source_text for segment in segments]
+    previous_texts = [segment.source_text for segment in previous_segments]
+    matcher = difflib.SequenceMatcher(
+        None, previous_texts, source_texts, autojunk=False
+    )
+
+    changed_segments = []
+
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            for previous, segment in zip(previous_segments[i1:i2], segments[j1:j2]):
+                segment.target_text = previous.target_text
+        elif tag in ("replace", "insert"):
+            changed_segments.extend(segments[j1:j2])
+
+    print(
+        "Segments reused from previous translation: "
+        + str(len(segments) - len(changed_segments))
+    )
+
+    return changed_segments
+
+
+def open_translation_memory(memory_file):
+    """
+    Opens (creating if necessary) the SQLite file holding the translation
+    memory, which maps each source text to its translation.
+    """
+
+    connection = sqlite3.connect(memory_file, isolation_level=None)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS memory ("
+        "source_text TEXT PRIMARY KEY, "
+        "target_text TEXT NOT NULL)"
+    )
+    return connection
+
+
+def read_tmx_chunks(tmx_file, repair=False):
+    """
+    Yields the content of a tmx file in chunks.
+    With repair=True, the file is read line by line and the text of each seg
+    is escaped, which fixes tmx files written by older versions of
+    create_tmx() that did not escape "&" and "<".
+    """
+
+    if not repair:
+        with open(tmx_file, "rb") as f:
+            yield from iter(lambda: f.read(TMX_READ_CHUNK_SIZE), b"")
+        return
+
+    def escape_seg(match):
+        return match.group(1) + escape(unescape(match.group(2))) + match.group(3)
+
+    with open(tmx_file, encoding="utf-8") as f:
+        for line in f:
+            yield TMX_SEG_PATTERN.sub(escape_seg, line)
+
+
+def read_tmx_units(tmx_file, repair=False):
+    """
+    Yields the JA source text and EN-US target text of each tu in a tmx file.
+    The file is parsed incrementally and each tu is discarded once read, so
+    memory use does not grow with the size of the file.
+    Raises xml.etree.ElementTree.ParseError if the file is not well-formed.
+    """
+
+    xml_lang = "{http://www.w3.org/XML/1998/namespace}lang"
+
+    parser = ET.XMLPullParser(events=("start", "end"))
+    parent = None
+
+    # A final None closes the parser, flushing any remaining events
+    chunks = itertools.chain(read_tmx_chunks(tmx_file, repair), [None])
+
+    for chunk in chunks:
+        if chunk is None:
+            parser.close()
+        else:
+            parser.feed(chunk)
+
+        for event, element in parser.read_events():
+            # Each tu is discarded from its parent (the body) once read
+            if event == "start":
+                if parent is None or element.tag == "body":
+                    parent = element
+                continue
+            if element.tag != "tu":
+                continue
+
+            source_text = None
+            target_text = None
+
+            # tmx 1.1 uses "lang", later versions use "xml:lang"
+            for tuv in element.iter("tuv"):
+                lang = (tuv.get("lang") or tuv.get(xml_lang) or "").upper()
+                seg = tuv.find("seg")
+                if seg is None:
+                    continue
+                if lang in ("JA", "JA-JP"):
+                    source_text = "".join(seg.itertext())
+                elif lang == "EN-US":
+                    target_text = "".join(seg.itertext())
+
+            if source_text and target_text:
+                yield source_text, target_text
+
+            parent.clear()
+
+
+def insert_tmx_units(connection, units):
+    """
+    Inserts translation units into the translation memory,
+    TMX_IMPORT_BATCH_SIZE units per transaction.
+    Returns the number of units inserted.
+    """
+
+    unit_count = 0
+
+    while True:
+        batch = list(itertools.islice(units, TMX_IMPORT_BATCH_SIZE))
+        if not batch:
+            break
+        connection.execute("BEGIN")
+        connection.executemany(
+            "INSERT OR REPLACE INTO memory (source_text, target_text) VALUES (?, ?)",
+            batch,
+        )
+        connection.execute("COMMIT")
+        unit_count += len(batch)
+
+    return unit_count
+
+
+def import_tmx(connection, tmx_file):
+    """
+    Bulk loads the translation units of a tmx file into the translation
+    memory, TMX_IMPORT_BATCH_SIZE units per transaction. Later units replace
+    earlier ones having the same source text.
+    If the file is not well-formed, for example because it was written by an
+    older version of create_tmx() that did not escape "&" and "<", it is read
+    again with the text of each seg escaped.
+    Returns the number of units imported.
+    Raises xml.etree.ElementTree.ParseError if the file still cannot be read.
+    """
+
+    print('Importing "' + tmx_file + '".')
+
+    start_time = time.perf_counter()
+
+    try:
+        unit_count = insert_tmx_units(connection, read_tmx_units(tmx_file))
+    except ET.ParseError as e:
+        # Units already committed are simply replaced when read again
+        print("The file is not well-formed (" + str(e) + ").")
+        print("Reading it again with the text of each seg escaped.")
+        unit_count = insert_tmx_units(
+            connection, read_tmx_units(tmx_file, repair=True)
+        )
+
+    # Report throughput, which can be used to benchmark large imports
+    seconds = max(time.perf_counter() - start_time, 1e-6)
+    megabytes = os.path.getsize(tmx_file) / 1000000
+    print(
+        "Imported "
+        + str(unit_count)
+        + " translation units ("
+        + format(megabytes, ".1f")
+        + " MB) in "
+        + format(seconds, ".1f")
+        + " s: "
+        + format(unit_count / seconds, ",.0f")
+        + " units/s, "
+        + format(megabytes / seconds, ".1f")
+        + " MB/s"
+    )
+
+    return unit_count
+
+
+def apply_translation_memory(connection, segments):
+    """
+    Copies over the translation of each segment whose source text exactly
+    matches an entry in the translation memory.
+    Returns the list of segments that were not found.
+    """
+
+    pending_segments = []
+
+    for segment in segments:
+        row = connection.execute(
+            "SELECT target_text FROM memory WHERE source_text = ?",
+            (segment.source_text,),
+        ).fetchone()
+        if row:
+            segment.target_text = row[0]
+        else:
+            pending_segments.append(segment)
+
+    return pending_segments
+
+
+def save_to_translation_memory(connection, segments):
+    connection.execute("BEGIN")
+    connection.executemany(
+        "INSERT OR REPLACE INTO memory (source_text, target_text) VALUES (?, ?)",
+        [
+            (segment.source_text, str(segment.target_text))
+            for segment in segments
+            if segment.source_text and segment.target_text
+        ],
+    )
+    connection.execute("COMMIT")
+
+
+def get_local_translation(source_text):
+    """
+    Returns the translation of a segment that needs no machine translation,
+    i.e. a paragraph label, figure reference, number, formula, chemical
+    notation or whitespace-only segment.
+    Returns None if the segment should be sent to DeepL.
+    """
+
+    # Whitespace is copied through as is
+    if not source_text or source_text.isspace():
+        return source_text
+
+    # Convert full-width characters to their half-width equivalents
+    text = source_text.translate(CIRCLED_NUMBERS)
+    text = unicodedata.normalize("NFKC", text).strip()
+
+    # 【０００１】 -> [0001]
+    match = PARAGRAPH_LABEL_PATTERN.fullmatch(text)
+    if match:
+        return "[" + match.group(1) + "]"
+
+    # 【図１】 -> [FIG. 1], 図１ -> FIG. 1
+    match = FIGURE_REFERENCE_PATTERN.fullmatch(text)
+    if match:
+        if match.group(3):
+            return "FIG. " + match.group(3)
+        return "[FIG. " + (match.group(1) or match.group(2)) + "]"
+
+    if NUMBER_OR_FORMULA_PATTERN.fullmatch(text):
+        return text
+
+    if CHEMICAL_NOTATION_PATTERN.fullmatch(text):
+        return text
+
+    return None
+
+
+def separate_local_segments(segments):
+    """
+    Translates locally those segments that need no machine translation.
+    Returns the list of remaining segments that are to be sent to DeepL.
+    """
+
+    pending_segments = []
+
+    for segment in segments:
+        target_text = get_local_translation(segment.source_text)
+        if target_text is None:
+            pending_segments.append(segment)
+        else:
+            segment.target_text = target_text
+
+    return pending_segments
+
+
+def get_alignment_cost(source_length, target_length, ratio):
+    """
+    Returns the cost (negative log probability) of aligning source text and
+    target text of the given lengths, where ratio is the expected number of
+    target characters per source character.
+    """
+
+    # Compare lengths in source characters
+    target_length /= ratio
+
+    if source_length == 0 and target_length == 0:
+        return 0
+
+    delta = (target_length - source_length) / math.sqrt(
+        (source_length + target_length) / 2 * ALIGNMENT_VARIANCE
+    )
+    probability = math.erfc(abs(delta) / math.sqrt(2))
+
+    return -math.log(max(probability, 1e-300))
+
+
+def align_by_length(source_texts, target_texts):
+    """
+    Aligns source and target texts (sentences or paragraphs) by their lengths
+    using the dynamic programming algorithm of Gale and Church, allowing 1-1,
+    1-0, 0-1, 2-1, 1-2 and 2-2 alignments.
+    Only a band around the diagonal is searched, so time and memory grow
+    linearly with the number of texts when their numbers are similar.
+    Returns a list of (source texts, target texts) pairs.
+    """
+
+    source_count = len(source_texts)
+    target_count = len(target_texts)
+
+    # Prefix sums, so that the length of any run of texts is a subtraction
+    source_ends = [0] + list(itertools.accumulate(len(text) for text in source_texts))
+    target_ends = [0] + list(itertools.accumulate(len(text) for text in target_texts))
+
+    # Expected length ratio, taken from the texts themselves
+    ratio = max(target_ends[-1], 1) / max(source_ends[-1], 1)
+
+    # Only alignments near the diagonal are searched. The band is wide enough
+    # for all the extra texts on one side to be inserted in a single place.
+    band = ALIGNMENT_BAND + abs(source_count - target_count)
+
+    # costs[i, j] is the cost of aligning the first i source texts with the
+    # first j target texts, and steps[i, j] the alignment used to get there.
+    costs = {(0, 0): 0}
+    steps = {}
+
+    for i in range(source_count + 1):
+        diagonal = round(i * target_count / max(source_count, 1))
+        first_j = max(diagonal - band, 0)
+        last_j = min(diagonal + band, target_count)
+        for j in range(first_j, last_j + 1):
+            for (di, dj), prior in ALIGNMENT_PRIORS.items():
+                previous_cost = costs.get((i - di, j - dj))
+                if previous_cost is None:
+                    continue
+                cost = (
+                    previous_cost
+                    - math.log(prior)
+                    + get_alignment_cost(
+                        source_ends[i] - source_ends[i - di],
+                        target_ends[j] - target_ends[j - dj],
+                        ratio,
+                    )
+                )
+                if cost < costs.get((i, j), math.inf):
+                    costs[i, j] = cost
+                    steps[i, j] = (di, dj)
+
+    # Trace back the lowest cost alignment
+    alignment = []
+    i = source_count
+    j = target_count
+    while i > 0 or j > 0:
+        di, dj = steps[i, j]
+        alignment.append((source_texts[i - di : i], target_texts[j - dj : j]))
+        i -= di
+        j -= dj
+
+    alignment.reverse()
+    return alignment
+
+
+def align_document(source_paragraphs, target_paragraphs):
+    """
+    Builds segments from the paragraphs of a document and its translation.
+    Paragraphs are aligned first (one to one when their numbers match), then
+    the sentences within each pair of aligned paragraphs.
+    Source sentences aligned to a single target sentence are merged into one
+    segment, and target sentences with no source sentence are added to the
+    previous segment.
+    """
+
+    if len(source_paragraphs) == len(target_paragraphs):
+        paragraph_alignment = [
+            ([source], [target])
+            for source, target in zip(source_paragraphs, target_paragraphs)
+        ]
+    else:
+        paragraph_alignment = align_by_length(source_paragraphs, target_paragraphs)
+
+    segments = []
+
+    for source_paras, target_paras in paragraph_alignment:
+        source_sentences = [
+            sentence
+            for para in source_paras
+            for sentence in split_source_paragraph(para)
+        ]
+        target_sentences = [
+            sentence
+            for para in target_paras
+            for sentence in split_target_paragraph(para)
+        ]
+
+        if len(source_sentences) == len(target_sentences):
+            sentence_alignment = [
+                ([source], [target])
+                for source, target in zip(source_sentences, target_sentences)
+            ]
+        else:
+            sentence_alignment = align_by_length(source_sentences, target_sentences)
+
+        for sources, targets in sentence_alignment:
+            if sources:
+                segment = Segment(
+                    source_text="".join(sources), target_text=" ".join(targets)
+                )
+                segments.append(segment)
+            elif segments and targets:
+                segments[-1].target_text = " ".join(
+                    [segments[-1].target_text] + targets
+                ).strip()
+
+    return segments
+
+
 def get_source_char_count(source_segments):
     source_strings = [segment.source_text for segment in source_segments]
     char_count = sum(len(i) for i in source_strings)
@@ -123,6 +954,68 @@ def check_deepl_usage(source_char_count, translator):
     return True
 
 
+def parse_glossary_lines(lines):
+    """
+    Parses the lines of a tab-delimited glossary.
+    Returns the entries, the line numbers of lines that could not be parsed,
+    and a dict of source terms that were given more than one target term.
+    When a source term is given more than once, the last target term is used.
+    """
+
+    entries = {}
+    malformed_lines = []
+    duplicates = {}
+
+    for line_number, line in enumerate(lines, start=1):
+        # Only add to entries if:
+        # - there are two entries on a line
+        # - both entries are not just whitespace
+        # - both entries contain characters
+        # Otherwise ignore the line.
+
+        source, tab, target = line.partition("\t")
+
+        if "\t" in target:
+            malformed_lines.append(line_number)
+            continue
+
+        source = source.strip()
+        target = target.strip()
+
+        if not tab or not source or not target:
+            # Blank lines are simply skipped rather than reported
+            if not line.isspace():
+                malformed_lines.append(line_number)
+            continue
+
+        if source in entries and entries[source] != target:
+            duplicates.setdefault(source, [entries[source]]).append(target)
+
+        entries[source] = target
+
+    return entries, malformed_lines, duplicates
+
+
+def output_glossary_report(malformed_lines, duplicates):
+    if malformed_lines:
+        print(
+            "Lines ignored as they are not formatted as "
+            "source-term<tab>target-term: "
+            + ", ".join(str(line_number) for line_number in malformed_lines)
+        )
+
+    for source, targets in duplicates.items():
+        print(
+            'Conflicting entries for "'
+            + source
+            + '": '
+            + ", ".join(targets)
+            + ' (using "'
+            + targets[-1]
+            + '")'
+        )
+
+
 def extract_glossary_entries(glossary_file):
     """
     Function to extract entries from user supplied glossary.
@@ -132,30 +1025,17 @@ def extract_glossary_entries(glossary_file):
 
     print("Reading glossary.")
 
-    entries = {}
-
     try:
         with open(glossary_file, encoding="utf-8") as f:
-            for line in f:
-                # Only add to entries if:
-                # - there are two entries on a line
-                # - both entries are not just whitespace
-                # - both entries contain characters
-                # Otherwise ignore the line.
-
-                line_entries = line.split("\t")
-                if len(line_entries) == 2:
-                    if not line_entries[0].isspace() and not line_entries[1].isspace():
-                        source = line_entries[0].strip()
-                        target = line_entries[1].strip()
-                        if source and target:
-                            entries[source] = target
+            entries, malformed_lines, duplicates = parse_glossary_lines(f)
 
     except Exception as e:
         print("An error occurred when reading your glossary file.\n" "Error details:")
         print(e)
         sys.exit()
 
+    output_glossary_report(malformed_lines, duplicates)
+
     # Check the length of the entries dict. If zero, output error message and
     # request user to check the formatting of the file content.
     if len(entries) == 0:
@@ -169,6 +1049,196 @@ def extract_glossary_entries(glossary_file):
     return entries
 
 
+def read_glossary_cache(cache_file):
+    """
+    Returns the contents of a glossary cache file, or None if the file is
+    missing or not a valid cache.
+    The cache is stored as JSON rather than pickled, as glossaries may be on
+    storage shared with other machines and unpickling can run arbitrary code.
+    """
+
+    try:
+        with open(cache_file, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not (
+        isinstance(cache, dict)
+        and isinstance(cache.get("mtime"), int)
+        and isinstance(cache.get("size"), int)
+        and isinstance(cache.get("hash"), str)
+        and isinstance(cache.get("entries"), dict)
+        and all(isinstance(target, str) for target in cache["entries"].values())
+    ):
+        return None
+
+    return cache
+
+
+def load_glossary_entries(glossary_file):
+    """
+    Returns the glossary entries from the compiled glossary cache saved next
+    to the glossary file, so that large glossaries are only parsed (and
+    validated) once.
+    The cache is used while the size and modification time of the glossary
+    file are unchanged, or otherwise while its content hash still matches.
+    """
+
+    cache_file = glossary_file + ".cache"
+    cache = read_glossary_cache(cache_file)
+
+    try:
+        stat = os.stat(glossary_file)
+        if (
+            cache
+            and cache["mtime"] == stat.st_mtime_ns
+            and cache["size"] == stat.st_size
+        ):
+            print("Reading glossary (cached).")
+            return cache["entries"]
+
+        with open(glossary_file, "rb") as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+
+    except OSError:
+        # Let extract_glossary_entries() report the error
+        return extract_glossary_entries(glossary_file)
+
+    if cache and cache["hash"] == content_hash:
+        print("Reading glossary (cached).")
+        entries = cache["entries"]
+    else:
+        entries = extract_glossary_entries(glossary_file)
+
+    cache = {
+        "mtime": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "hash": content_hash,
+        "entries": entries,
+    }
+
+    # Write to a uniquely named temporary file first, so that a partly written
+    # cache is never read, even when several workers save the cache at once.
+    try:
+        fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file) or ".")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(cache, f, ensure_ascii=False)
+            os.replace(temp_file, cache_file)
+        except OSError:
+            os.remove(temp_file)
+            raise
+    except OSError as e:
+        print("The glossary cache could not be saved: " + str(e))
+
+    return entries
+
+
+def compile_glossary_matcher(entries):
+    """
+    Indexes the glossary source terms by their first character, giving the
+    lengths of the terms starting with that character (longest first).
+    Used by find_glossary_terms() to look up terms at each position of a text
+    with a few dict lookups, however large the glossary.
+    """
+
+    term_lengths = {}
+
+    for source_term in entries:
+        term_lengths.setdefault(source_term[0], set()).add(len(source_term))
+
+    return {
+        first_char: sorted(lengths, reverse=True)
+        for first_char, lengths in term_lengths.items()
+    }
+
+
+def find_glossary_terms(matcher, entries, text):
+    """
+    Returns the glossary source terms found in a text, in order and without
+    repeats. At each position the longest term is taken, and the search then
+    continues after it.
+    """
+
+    found_terms = {}
+    position = 0
+
+    while position < len(text):
+        for length in matcher.get(text[position], ()):
+            term = text[position : position + length]
+            if term in entries:
+                found_terms[term] = None
+                position += length
+                break
+        else:
+            position += 1
+
+    return list(found_terms)
+
+
+def check_glossary_compliance(segments, entries, matcher=None):
+    """
+    Checks that the target term is used in the translation of every segment
+    containing a glossary source term.
+    The matcher from compile_glossary_matcher() can be given so that it is
+    only built once when checking the same glossary again.
+    Returns a list of (segment index, source term, target term) for each
+    target term that is missing.
+    """
+
+    if matcher is None:
+        matcher = compile_glossary_matcher(entries)
+
+    issues = []
+
+    for index, segment in enumerate(segments):
+        if not segment.source_text:
+            continue
+        target_text = str(segment.target_text).lower()
+        for source_term in find_glossary_terms(matcher, entries, segment.source_text):
+            target_term = entries[source_term]
+            if target_term.lower() not in target_text:
+                issues.append((index, source_term, target_term))
+
+    return issues
+
+
+def create_glossary_report(report_name, segments, issues):
+    output_file = report_name + "-translated-glossary-check.txt"
+
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write("Segments missing glossary terms: " + str(len(issues)) + "\n")
+
+        for index, source_term, target_term in issues:
+            segment = segments[index]
+            f.write(
+                "\nSegment "
+                + str(index + 1)
+                + ': "'
+                + source_term
+                + '" should be translated as "'
+                + target_term
+                + '"\n'
+                + "  "
+                + str(segment.source_text)
+                + "\n"
+                + "  "
+                + str(segment.target_text)
+                + "\n"
+            )
+
+    print(
+        "Glossary terms missing from the translation: "
+        + str(len(issues))
+        + ' (see "'
+        + output_file
+        + '")'
+    )
+
+    return output_file
+
+
 def get_filename(whole_file_path):
     """
     Used to get the name of a given file, which is then used to build a name
@@ -196,8 +1266,6 @@ def create_deepl_glossary(translator, glossary_name, entries):
 
 
 def translate_segments(translator, segments, glossary):
-    print("Getting the translation from DeepL (this may take a little while) ...")
-
     # Perform translation using glossary
     if glossary:
         # Get translation for each segment, one segment at a time
@@ -234,8 +1302,106 @@ def translate_segments(translator, segments, glossary):
     return segments
 
 
-def create_docx(docx_name, translated_segments):
-    output_file = docx_name + "-translated.docx"
+async def translate_text_async(client, source_text, glossary):
+    data = {"text": source_text, "source_lang": "JA", "target_lang": "EN-US"}
+    if glossary:
+        data["glossary_id"] = glossary.glossary_id
+
+    for attempt in range(ASYNC_MAX_ATTEMPTS):
+        response = await client.post("/v2/translate", data=data)
+        # Retry with backoff if there are too many requests or DeepL is busy
+        if response.status_code != 429 and response.status_code < 500:
+            break
+        if attempt < ASYNC_MAX_ATTEMPTS - 1:
+            await asyncio.sleep(2**attempt)
+
+    if response.status_code != 200:
+        raise deepl.DeepLException(
+            "DeepL request failed with status "
+            + str(response.status_code)
+            + ": "
+            + response.text
+        )
+
+    return response.json()["translations"][0]["text"]
+
+
+async def translate_segments_async(
+    client, segments, glossary, max_requests=ASYNC_MAX_REQUESTS, timeout=None
+):
+    """
+    Async counterpart of translate_segments(), for use with a client from
+    setup_deepl_async_client().
+    Up to max_requests segments are translated at a time, and each segment
+    is yielded, in order, as soon as its translation is ready.
+    Raises asyncio.TimeoutError if the whole job takes longer than timeout
+    seconds. Requests still in flight are cancelled if the job times out or
+    is cancelled. To stop iterating early, close the generator with
+    aclose(), for example by iterating inside
+    "async with contextlib.aclosing(translate_segments_async(...)) as results:",
+    otherwise its requests are only cancelled when it is garbage collected.
+    The glossary, if given, is deleted from the DeepL platform afterwards,
+    unless the generator is never iterated over, in which case no requests
+    are made and the glossary is left for the caller to delete.
+    """
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_requests)
+
+    if timeout is None:
+        deadline = None
+    else:
+        deadline = loop.time() + timeout
+
+    async def translate_segment(segment):
+        async with semaphore:
+            segment.target_text = await translate_text_async(
+                client, segment.source_text, glossary
+            )
+
+    tasks = [
+        asyncio.ensure_future(translate_segment(segment))
+        for segment in segments
+        if segment.source_text
+    ]
+
+    try:
+        pending_tasks = iter(tasks)
+        for segment in segments:
+            if not segment.source_text:
+                segment.target_text = ""
+                yield segment
+                continue
+
+            task = next(pending_tasks)
+            if deadline is not None:
+                await asyncio.wait([task], timeout=max(deadline - loop.time(), 0))
+                if not task.done():
+                    raise asyncio.TimeoutError()
+            await task
+            yield segment
+
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Delete glossary from DeepL platform. An error here is only reported,
+        # so that it does not replace an error or cancellation of the job.
+        if glossary:
+            try:
+                await client.delete("/v2/glossaries/" + glossary.glossary_id)
+            except httpx.HTTPError as e:
+                print("An error occurred when deleting the glossary from DeepL.")
+                print("Error details:")
+                print(e)
+
+
+def write_docx(output, translated_segments):
+    """
+    Writes the segments as a two-column table to a docx file, given as a
+    path or a binary file-like object.
+    """
 
     document = Document()
     table = document.add_table(rows=1, cols=2, style="Table Grid")
@@ -251,41 +1417,105 @@ def create_docx(docx_name, translated_segments):
         row_cells[0].text = str(segment.source_text)
         row_cells[1].text = str(segment.target_text)
 
-    document.save(output_file)
-    print('Translation saved as "' + output_file + '".')
+    document.save(output)
 
 
-def create_tmx(tmx_name, translated_segments):
-    output_file = tmx_name + "-translated.tmx"
+def write_tmx(output, translated_segments):
+    """
+    Writes the segments as a tmx file to a binary file-like object.
+    """
 
-    with open(output_file, "w") as f:
-        # Write the start of the tmx file
-        f.write(
+    # Write the start of the tmx file
+    output.write(
+        (
             '<?xml version="1.0" encoding="UTF-8"?>\n'
             '<!DOCTYPE tmx SYSTEM "tmx11.dtd">\n'
             '<tmx version="1.1">\n'
             '  <header creationtool="deepl-allign" adminlang="EN-US" datatype="plaintext" '
             'segtype="sentence" srclang="JA"/>\n'
             "  <body>\n"
-        )
+        ).encode("utf-8")
+    )
 
-        # Append the content of each segment to the tmx file
-        for segment in translated_segments:
-            f.write(
+    # Append the content of each segment to the tmx file
+    for segment in translated_segments:
+        output.write(
+            (
                 "    <tu>\n"
                 '      <tuv lang="JA">\n'
-                "        <seg>" + str(segment.source_text) + "</seg>\n"
+                "        <seg>" + escape(str(segment.source_text)) + "</seg>\n"
                 "      </tuv>\n"
                 '      <tuv lang="EN-US">\n'
-                "        <seg>" + str(segment.target_text) + "</seg>\n"
+                "        <seg>" + escape(str(segment.target_text)) + "</seg>\n"
                 "      </tuv>\n"
                 "    </tu>\n"
+            ).encode("utf-8")
+        )
+
+    # Write the end of the tmx file
+    output.write(("  </body>\n" "</tmx>\n\n").encode("utf-8"))
+
+
+def create_docx(docx_name, translated_segments):
+    output_file = docx_name + "-translated.docx"
+
+    write_docx(output_file, translated_segments)
+    print('Translation saved as "' + output_file + '".')
+
+    return output_file
+
+
+def create_tmx(tmx_name, translated_segments):
+    output_file = tmx_name + "-translated.tmx"
+
+    with open(output_file, "wb") as f:
+        write_tmx(f, translated_segments)
+
+    print('Translation saved as "' + output_file + '".')
+
+    return output_file
+
+
+def translate_docx(translator, source, output_format, glossary=None, output=None):
+    """
+    Library counterpart of translate_document() that works without files.
+    The docx to be translated is given as bytes or a binary file-like object.
+    The tmx or docx translation is written to the output stream (a binary
+    stream, or a text stream with a binary buffer such as sys.stdout) if
+    given. Otherwise it is returned as bytes.
+    The glossary, if given, is deleted from the DeepL platform afterwards, as
+    in translate_segments(). Nothing is printed, and the monthly limit is not
+    checked.
+    """
+
+    if output is None:
+        result = io.BytesIO()
+    elif isinstance(output, io.TextIOBase):
+        # Write to the underlying binary buffer of text streams like stdout
+        if not hasattr(output, "buffer"):
+            raise TypeError(
+                "output must be a binary stream or a text stream with a binary "
+                "buffer, not " + type(output).__name__
             )
+        output.flush()
+        result = output.buffer
+    else:
+        result = output
+
+    segments = get_source_segments(source)
+    pending_segments = separate_local_segments(segments)
+    translate_segments(translator, pending_segments, glossary)
+
+    if output_format == "docx":
+        write_docx(result, segments)
+    else:
+        write_tmx(result, segments)
 
-        # Write the end of the tmx file
-        f.write("  </body>\n" "</tmx>\n\n")
+    if output is None:
+        return result.getvalue()
 
-        print('Translation saved as "' + output_file + '".')
+    result.flush()
+    return None
 
 
 def output_deepl_usage(translator):
@@ -297,39 +1527,494 @@ def output_deepl_usage(translator):
     )
 
 
-if __name__ == "__main__":
-    valid, output_format, source_file, glossary_file = check_user_input(sys.argv)
+def profile_stage(profiler, name):
+    """
+    Returns a context manager recording a stage of the pipeline with the
+    profiler, or one that does nothing if profiling is off.
+    """
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+
+def translate_document(
+    translator,
+    output_format,
+    source_file,
+    glossary_file,
+    previous_file=None,
+    resend=False,
+    memory_file=None,
+    profiler=None,
+    output_dir=None,
+):
+    """
+    Translates a docx file and saves the translation as a tmx or docx file,
+    in output_dir if given, otherwise in the current directory.
+    Segments found in the translation memory, if given, are not sent to
+    DeepL, and new translations, including those of segments translated
+    again, are saved to it.
+    When a glossary is used, a report of segments in which glossary terms
+    were not used is saved as well, and with resend these segments are
+    translated again first.
+    Returns the name of the output file, or None if translating the file
+    would exceed the monthly limit.
+    """
 
-    if valid:
-        translator = setup_deepl_translator()
+    with profile_stage(profiler, "extraction"):
         source_segments = get_source_segments(source_file)
-        source_char_count = get_source_char_count(source_segments)
-
-        if check_deepl_usage(source_char_count, translator):
-            if glossary_file:
-                glossary_entries = extract_glossary_entries(glossary_file)
-                glossary_name = get_filename(glossary_file)
-                glossary = create_deepl_glossary(
-                    translator, glossary_name, glossary_entries
-                )
-                translated_segments = translate_segments(
-                    translator, source_segments, glossary
-                )
-            else:
-                translated_segments = translate_segments(
-                    translator, source_segments, None
+
+        # Only send inserted or changed segments when updating a previous
+        # translation.
+        if previous_file:
+            previous_segments = get_previous_segments(previous_file)
+            pending_segments = reuse_previous_translations(
+                source_segments, previous_segments
+            )
+        else:
+            pending_segments = source_segments
+
+        # Keep paragraph labels, numbers, etc. out of the DeepL requests.
+        local_segment_count = len(pending_segments)
+        pending_segments = separate_local_segments(pending_segments)
+        local_segment_count -= len(pending_segments)
+        print(
+            "Segments not requiring machine translation: " + str(local_segment_count)
+        )
+
+        if memory_file:
+            memory = open_translation_memory(memory_file)
+            memory_segment_count = len(pending_segments)
+            pending_segments = apply_translation_memory(memory, pending_segments)
+            memory_segment_count -= len(pending_segments)
+            print(
+                "Segments found in translation memory: " + str(memory_segment_count)
+            )
+
+        source_char_count = get_source_char_count(pending_segments)
+
+    if not check_deepl_usage(source_char_count, translator):
+        return None
+
+    with profile_stage(profiler, "glossary"):
+        if glossary_file and pending_segments:
+            glossary_entries = load_glossary_entries(glossary_file)
+            glossary_name = get_filename(glossary_file)
+            glossary = create_deepl_glossary(
+                translator, glossary_name, glossary_entries
+            )
+        else:
+            glossary = None
+
+    file_name = get_filename(source_file)
+    if output_dir:
+        file_name = os.path.join(output_dir, file_name)
+
+    with profile_stage(profiler, "translation"):
+        print("Getting the translation from DeepL (this may take a little while) ...")
+        translate_segments(translator, pending_segments, glossary)
+
+        # Segments whose translation came from DeepL in this run
+        translated_segments = pending_segments
+
+        if glossary:
+            matcher = compile_glossary_matcher(glossary_entries)
+            issues = check_glossary_compliance(
+                source_segments, glossary_entries, matcher
+            )
+
+            if resend and issues:
+                resend_segments = [
+                    source_segments[index]
+                    for index in dict.fromkeys(index for index, _, _ in issues)
+                ]
+                resend_char_count = sum(
+                    len(segment.source_text) for segment in resend_segments
                 )
 
+                if check_deepl_usage(resend_char_count, translator):
+                    print(
+                        "Translating again segments missing glossary terms: "
+                        + str(len(resend_segments))
+                    )
+                    # translate_segments() deletes the glossary once done, so
+                    # upload it again.
+                    glossary = create_deepl_glossary(
+                        translator, glossary_name, glossary_entries
+                    )
+                    translate_segments(translator, resend_segments, glossary)
+                    translated_segments = translated_segments + resend_segments
+                    issues = check_glossary_compliance(
+                        source_segments, glossary_entries, matcher
+                    )
+
+    with profile_stage(profiler, "writing"):
+        if glossary:
+            create_glossary_report(file_name, source_segments, issues)
+
+        if memory_file:
+            save_to_translation_memory(memory, translated_segments)
+            memory.close()
+
+        if output_format == "docx":
+            return create_docx(file_name, source_segments)
+        return create_tmx(file_name, source_segments)
+
+
+def translate_whole_document(
+    translator, output_format, source_file, glossary_file, profiler=None
+):
+    """
+    Translates a docx file by uploading it to DeepL as a single document,
+    rather than one request per segment, then aligns the sentences of the
+    downloaded translation with those of the source text by their lengths.
+    Saves the aligned translation as a tmx or docx file.
+    Returns the name of the output file, or None if translating the file
+    would exceed the monthly limit.
+    """
+
+    with profile_stage(profiler, "extraction"):
+        print('Extracting text from "' + source_file + '".')
+
+        source_paragraphs = [para.text for para in Document(source_file).paragraphs]
+        source_char_count = sum(len(para) for para in source_paragraphs)
+        print("Characters extracted: " + str(source_char_count))
+
+    # DeepL bills a minimum number of characters per document
+    billed_char_count = max(source_char_count, DOCUMENT_MIN_BILLED_CHARACTERS)
+    if not check_deepl_usage(billed_char_count, translator):
+        return None
+
+    with profile_stage(profiler, "glossary"):
+        if glossary_file:
+            glossary_entries = load_glossary_entries(glossary_file)
+            glossary_name = get_filename(glossary_file)
+            glossary = create_deepl_glossary(
+                translator, glossary_name, glossary_entries
+            )
         else:
-            output_deepl_usage(translator)
-            print("The monthly limit has been reached." "Please try again next month.")
-            sys.exit()
+            glossary = None
+
+    with profile_stage(profiler, "translation"):
+        print("Uploading the document to DeepL (this may take a little while) ...")
+
+        with open(source_file, "rb") as f:
+            handle = translator.translate_document_upload(
+                f,
+                source_lang="JA",
+                target_lang="en-US",
+                glossary=glossary,
+                filename=os.path.basename(source_file),
+            )
+
+        while True:
+            status = translator.translate_document_get_status(handle)
+            if not status.ok:
+                if glossary:
+                    translator.delete_glossary(glossary)
+                print("An error occurred when DeepL was translating your document.")
+                print("Error details:")
+                print(status.error_message)
+                sys.exit()
+            if status.done:
+                break
+            time.sleep(
+                min(max(status.seconds_remaining or 0, 1), DOCUMENT_POLL_SECONDS)
+            )
 
+        translated_file = io.BytesIO()
+        translator.translate_document_download(handle, translated_file)
+        translated_file.seek(0)
+
+        # Delete glossary from DeepL platform
+        if glossary:
+            translator.delete_glossary(glossary)
+
+        target_paragraphs = [
+            para.text for para in Document(translated_file).paragraphs
+        ]
+        segments = align_document(source_paragraphs, target_paragraphs)
+
+    with profile_stage(profiler, "writing"):
         file_name = get_filename(source_file)
 
         if output_format == "docx":
-            create_docx(file_name, translated_segments)
-        else:
-            create_tmx(file_name, translated_segments)
+            return create_docx(file_name, segments)
+        return create_tmx(file_name, segments)
+
+
+def open_job_queue(queue_file):
+    """
+    Opens (creating if necessary) the SQLite file holding the job queue.
+    Several worker processes, on one or more machines, can share the same
+    queue file.
+    """
+
+    # Transactions are started explicitly with "BEGIN IMMEDIATE" so that
+    # only one worker at a time can claim a job.
+    connection = sqlite3.connect(queue_file, timeout=60, isolation_level=None)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "id INTEGER PRIMARY KEY, "
+        "source_file TEXT NOT NULL, "
+        "output_format TEXT NOT NULL, "
+        "glossary_file TEXT, "
+        "status TEXT NOT NULL DEFAULT 'pending', "
+        "attempts INTEGER NOT NULL DEFAULT 0, "
+        "worker TEXT, "
+        "lease_expires REAL, "
+        "result TEXT)"
+    )
+    return connection
+
+
+def add_jobs(connection, output_format, source_files, glossary_file):
+    if glossary_file:
+        glossary_file = os.path.abspath(glossary_file)
+
+    connection.execute("BEGIN IMMEDIATE")
+    connection.executemany(
+        "INSERT INTO jobs (source_file, output_format, glossary_file) "
+        "VALUES (?, ?, ?)",
+        [
+            (os.path.abspath(source_file), output_format, glossary_file)
+            for source_file in source_files
+        ],
+    )
+    connection.execute("COMMIT")
+    print("Jobs added to the queue: " + str(len(source_files)))
+
+
+def claim_job(connection, worker_id):
+    """
+    Leases the next pending job, or a job whose previous worker stopped
+    renewing its lease, to the given worker.
+    Returns the job as (id, source_file, output_format, glossary_file), or
+    None if there are no jobs left to claim.
+    """
+
+    now = time.time()
+
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        # Jobs abandoned on their last attempt are not retried
+        connection.execute(
+            "UPDATE jobs SET status = 'failed', result = 'Lease expired.' "
+            "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+            (now, JOB_MAX_ATTEMPTS),
+        )
+        job = connection.execute(
+            "SELECT id, source_file, output_format, glossary_file FROM jobs "
+            "WHERE status = 'pending' "
+            "OR (status = 'running' AND lease_expires < ?) "
+            "ORDER BY id LIMIT 1",
+            (now,),
+        ).fetchone()
+        if job:
+            connection.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, "
+                "lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker_id, now + JOB_LEASE_SECONDS, job[0]),
+            )
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+    return job
+
+
+def renew_job_lease(connection, job_id, worker_id):
+    connection.execute(
+        "UPDATE jobs SET lease_expires = ? "
+        "WHERE id = ? AND worker = ? AND status = 'running'",
+        (time.time() + JOB_LEASE_SECONDS, job_id, worker_id),
+    )
+
+
+def complete_job(connection, job_id, worker_id, output_file):
+    connection.execute(
+        "UPDATE jobs SET status = 'done', result = ? "
+        "WHERE id = ? AND worker = ? AND status = 'running'",
+        (os.path.abspath(output_file), job_id, worker_id),
+    )
+
+
+def fail_job(connection, job_id, worker_id, error):
+    """
+    Returns a failed job to the queue to be retried, or marks it as failed
+    if it has already been attempted JOB_MAX_ATTEMPTS times.
+    """
+    connection.execute(
+        "UPDATE jobs SET "
+        "status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+        "result = ? "
+        "WHERE id = ? AND worker = ? AND status = 'running'",
+        (JOB_MAX_ATTEMPTS, error, job_id, worker_id),
+    )
+
+
+def start_job_heartbeat(queue_file, job_id, worker_id):
+    """
+    Renews the lease of a job from a background thread while it is being
+    translated. Returns an Event that stops the heartbeat when set.
+    """
+
+    stop = threading.Event()
+
+    def heartbeat():
+        # SQLite connections cannot be shared between threads
+        connection = open_job_queue(queue_file)
+        while not stop.wait(JOB_HEARTBEAT_SECONDS):
+            # Keep trying if the queue is busy, as the lease is lost if the
+            # heartbeat stops.
+            try:
+                renew_job_lease(connection, job_id, worker_id)
+            except sqlite3.Error as e:
+                print("Job " + str(job_id) + ": could not renew lease: " + str(e))
+        connection.close()
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    return stop
+
+
+def run_worker(queue_file, translator):
+    """
+    Claims and translates jobs from the queue until there are none left, or
+    until the monthly limit is reached.
+    Each translation is saved next to its source file, so that source files
+    with the same name in different directories do not overwrite each other.
+    """
+
+    worker_id = socket.gethostname() + ":" + str(os.getpid())
+    connection = open_job_queue(queue_file)
+
+    while True:
+        job = claim_job(connection, worker_id)
+        if job is None:
+            print("No more jobs in the queue.")
+            break
+
+        job_id, source_file, output_format, glossary_file = job
+        print("Job " + str(job_id) + ': "' + source_file + '"')
+
+        stop_heartbeat = start_job_heartbeat(queue_file, job_id, worker_id)
+        try:
+            output_file = translate_document(
+                translator,
+                output_format,
+                source_file,
+                glossary_file,
+                output_dir=os.path.dirname(source_file),
+            )
+        # Also catch the SystemExit raised on unreadable files, so that one
+        # bad job does not stop the worker.
+        except (Exception, SystemExit) as e:
+            print("Job " + str(job_id) + " failed: " + str(e))
+            fail_job(connection, job_id, worker_id, str(e) or type(e).__name__)
+            continue
+        finally:
+            stop_heartbeat.set()
+
+        if output_file is None:
+            fail_job(
+                connection, job_id, worker_id, "The monthly limit has been reached."
+            )
+            print("The monthly limit has been reached." "Please try again next month.")
+            break
+
+        complete_job(connection, job_id, worker_id, output_file)
+
+    connection.close()
+
+
+def output_job_queue_status(connection):
+    counts = connection.execute(
+        "SELECT status, COUNT(*) FROM jobs GROUP BY status ORDER BY status"
+    ).fetchall()
+    return "Jobs in the queue: " + ", ".join(
+        status + " " + str(count) for status, count in counts
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "import":
+        valid, memory_file, tmx_files = check_import_input(sys.argv)
+
+        if valid:
+            memory = open_translation_memory(memory_file)
+            for tmx_file in tmx_files:
+                # A file that cannot be read is reported and skipped
+                try:
+                    import_tmx(memory, tmx_file)
+                except (OSError, UnicodeDecodeError, ET.ParseError) as e:
+                    print('An error occurred when importing "' + tmx_file + '".')
+                    print("Error details:")
+                    print(e)
+            memory.close()
+
+    elif len(sys.argv) > 1 and sys.argv[1] in ("queue", "worker"):
+        (
+            valid,
+            command,
+            queue_file,
+            output_format,
+            source_files,
+            glossary_file,
+        ) = check_queue_input(sys.argv)
+
+        if valid:
+            if command == "queue":
+                connection = open_job_queue(queue_file)
+                add_jobs(connection, output_format, source_files, glossary_file)
+            else:
+                translator = setup_deepl_translator()
+                run_worker(queue_file, translator)
+                print(output_deepl_usage(translator))
+                connection = open_job_queue(queue_file)
+
+            print(output_job_queue_status(connection))
+
+    else:
+        valid, user_input, options = check_user_options(sys.argv)
+
+        if valid:
+            valid, output_format, source_file, glossary_file = check_user_input(
+                user_input
+            )
+
+        if valid:
+            translator = setup_deepl_translator()
+
+            if options["--profile"]:
+                profiler = Profiler()
+            else:
+                profiler = None
+
+            if options["--document"]:
+                output_file = translate_whole_document(
+                    translator, output_format, source_file, glossary_file, profiler
+                )
+            else:
+                output_file = translate_document(
+                    translator,
+                    output_format,
+                    source_file,
+                    glossary_file,
+                    options["--previous"],
+                    options["--resend"],
+                    options["--memory"],
+                    profiler,
+                )
+
+            if profiler:
+                profiler.save(get_filename(source_file) + "-translated")
+
+            if output_file is None:
+                print(output_deepl_usage(translator))
+                print(
+                    "The monthly limit has been reached." "Please try again next month."
+                )
+                sys.exit()
 
-        print(output_deepl_usage(translator))
+            print(output_deepl_usage(translator))